@@ -7,12 +7,12 @@ from urlparse import urljoin
 from twisted.web import http
 from twisted.internet import reactor
 from twisted.internet.task import Clock
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from twisted.web.client import HTTPConnectionPool
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import Protocol
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, fail)
 from twisted.web.server import NOT_DONE_YET
 
-import treq
-
 from vumi.tests.helpers import VumiTestCase
 from vumi.transports.httprpc.tests.helpers import HttpRpcTransportHelper
 from vumi.tests.utils import LogCatcher
@@ -35,9 +35,6 @@ class TestVas2NetsSmsTransport(VumiTestCase):
         self.tx_helper = self.add_helper(
             HttpRpcTransportHelper(Vas2NetsSmsTransport))
 
-        connection_pool = HTTPConnectionPool(reactor, persistent=False)
-        treq._utils.set_global_pool(connection_pool)
-
     @inlineCallbacks
     def mk_transport(self, **kw):
         config = {
@@ -84,6 +81,29 @@ class TestVas2NetsSmsTransport(VumiTestCase):
     def remote_handle_request(self, req):
         return self.remote_request_handler(req)
 
+    @inlineCallbacks
+    def mk_raw_request(self, transport, **params):
+        """
+        Make a request to the transport over a plain TCP connection, and
+        return the raw response, since the http client strips the connection
+        headers we want to check.
+        """
+        addr = transport.web_resource.getHost()
+        endpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', addr.port)
+        proto = yield connectProtocol(endpoint, RawResponseProtocol())
+
+        proto.transport.write(
+            'GET %s?%s HTTP/1.1\r\n'
+            'Host: %s\r\n'
+            'Connection: close\r\n\r\n' % (
+                transport.config['web_path'],
+                urlencode(params),
+                self.get_host(transport)))
+
+        response = yield proto.done
+        head, body = response.split('\r\n\r\n', 1)
+        returnValue((head.split('\r\n'), body))
+
     def get_host(self, transport):
         addr = transport.web_resource.getHost()
         return '%s:%s' % (addr.host, addr.port)
@@ -126,6 +146,7 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             msgid='789')
 
         self.assertEqual(res.code, http.OK)
+        self.assertEqual(res.delivered_body, '{}')
 
         [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
 
@@ -149,6 +170,150 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Request successful',
         })
 
+    @inlineCallbacks
+    def test_inbound_publish_failure(self):
+        transport = yield self.mk_transport()
+        self.patch(
+            transport, 'publish_message', lambda **kw: fail(ValueError()))
+
+        d = transport.handle_inbound_message('1', None, {
+            'sender': '+123',
+            'receiver': '456',
+            'msgdata': 'hi',
+            'operator': 'MTN',
+            'recvtime': '2012-02-27 19-50-07',
+            'msgid': '789',
+        })
+
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.tx_helper.get_dispatched_statuses(), [])
+
+    @inlineCallbacks
+    def test_inbound_response_content_length(self):
+        transport = yield self.mk_transport()
+
+        head, body = yield self.mk_raw_request(
+            transport,
+            sender='+123',
+            receiver='456',
+            msgdata='hi',
+            operator='MTN',
+            recvtime='2012-02-27 19-50-07',
+            msgid='789')
+
+        self.assertEqual(head[0], 'HTTP/1.1 200 OK')
+        self.assertTrue('Content-Length: 2' in head)
+        self.assertFalse(
+            any(h.startswith('Transfer-Encoding') for h in head))
+        self.assertEqual(body, '{}')
+
+    @inlineCallbacks
+    def test_inbound_bad_params_response_content_length(self):
+        transport = yield self.mk_transport()
+
+        with LogCatcher():
+            head, body = yield self.mk_raw_request(
+                transport,
+                sender='+123',
+                operator='MTN',
+                recvtime='2012-02-27 19-50-07',
+                msgid='789')
+
+        self.assertEqual(head[0], 'HTTP/1.1 400 Bad Request')
+        self.assertTrue('Content-Length: %d' % (len(body),) in head)
+        self.assertFalse(
+            any(h.startswith('Transfer-Encoding') for h in head))
+        self.assertEqual(
+            sorted(json.loads(body)['missing_parameter']),
+            ['msgdata', 'receiver'])
+
+    @inlineCallbacks
+    def test_inbound_duplicate(self):
+        yield self.mk_transport(inbound_dedup_size=10)
+
+        for _ in range(2):
+            res = yield self.tx_helper.mk_request(
+                sender='+123',
+                receiver='456',
+                msgdata='hi',
+                operator='MTN',
+                recvtime='2012-02-27 19-50-07',
+                msgid='789')
+
+            self.assertEqual(res.code, http.OK)
+
+        yield self.tx_helper.mk_request(
+            sender='+123',
+            receiver='456',
+            msgdata='hi again',
+            operator='MTN',
+            recvtime='2012-02-27 19-50-08',
+            msgid='790')
+
+        msgs = yield self.tx_helper.wait_for_dispatched_inbound(2)
+
+        self.assertEqual(
+            [msg['content'] for msg in msgs],
+            ['hi', 'hi again'])
+
+    @inlineCallbacks
+    def test_inbound_duplicate_in_flight(self):
+        transport = yield self.mk_transport(inbound_dedup_size=10)
+
+        published = []
+        pending = []
+
+        def publish_message(**kw):
+            published.append(kw)
+            d = Deferred()
+            pending.append(d)
+            return d
+
+        self.patch(transport, 'publish_message', publish_message)
+
+        vals = {
+            'sender': '+123',
+            'receiver': '456',
+            'msgdata': 'hi',
+            'operator': 'MTN',
+            'recvtime': '2012-02-27 19-50-07',
+            'msgid': '789',
+        }
+
+        # The id is only remembered once a publish completes, so both
+        # in-flight requests are published
+        d1 = transport.handle_inbound_message('1', None, vals)
+        d2 = transport.handle_inbound_message('2', None, vals)
+        self.assertEqual(len(published), 2)
+
+        for d in pending:
+            d.callback(None)
+
+        yield d1
+        yield d2
+
+        yield transport.handle_inbound_message('3', None, vals)
+        self.assertEqual(len(published), 2)
+
+    @inlineCallbacks
+    def test_inbound_duplicate_dedup_disabled(self):
+        yield self.mk_transport()
+
+        for _ in range(2):
+            yield self.tx_helper.mk_request(
+                sender='+123',
+                receiver='456',
+                msgdata='hi',
+                operator='MTN',
+                recvtime='2012-02-27 19-50-07',
+                msgid='789')
+
+        msgs = yield self.tx_helper.wait_for_dispatched_inbound(2)
+
+        self.assertEqual(
+            [msg['content'] for msg in msgs],
+            ['hi', 'hi'])
+
     @inlineCallbacks
     def test_inbound_decode_error(self):
         transport = yield self.mk_transport()
@@ -247,6 +412,42 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             sorted(status['details']['errors']['missing_parameter']),
             ['msgdata', 'receiver'])
 
+    @inlineCallbacks
+    def test_inbound_bad_params_large_content(self):
+        yield self.mk_transport()
+
+        yield self.tx_helper.mk_request(
+            _method='POST',
+            _data='a' * 5000,
+            sender='+123',
+            operator='MTN',
+            recvtime='2012-02-27 19-50-07',
+            msgid='789')
+
+        [status] = self.tx_helper.get_dispatched_statuses()
+        req = status['details']['request']
+
+        self.assertEqual(req['content'], 'a' * 4096)
+        self.assertTrue(req['content_truncated'])
+
+    @inlineCallbacks
+    def test_inbound_bad_params_large_multibyte_content(self):
+        yield self.mk_transport()
+
+        yield self.tx_helper.mk_request(
+            _method='POST',
+            _data='a' + u'é'.encode('utf-8') * 3000,
+            sender='+123',
+            operator='MTN',
+            recvtime='2012-02-27 19-50-07',
+            msgid='789')
+
+        [status] = self.tx_helper.get_dispatched_statuses()
+        req = status['details']['request']
+
+        self.assertEqual(req['content'], u'a' + u'é' * 2047)
+        self.assertTrue(req['content_truncated'])
+
     @inlineCallbacks
     def test_outbound_non_reply(self):
         yield self.mk_transport(
@@ -289,6 +490,61 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Request successful',
         })
 
+    @inlineCallbacks
+    def test_outbound_redirect(self):
+        def handler(req):
+            if req.path == '/nonreply':
+                req.redirect(urljoin(self.remote_server.url, 'redirected'))
+                return ''
+
+            reqs.append(req)
+            return 'OK.1234'
+
+        reqs = []
+        self.remote_request_handler = handler
+        yield self.mk_transport()
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [req] = reqs
+        self.assertTrue(req.uri.startswith('/redirected'))
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+
+        self.assert_contains_items(ack, {
+            'event_type': 'ack',
+            'user_message_id': msg['message_id'],
+            'sent_message_id': msg['message_id'],
+        })
+
+    @inlineCallbacks
+    def test_outbound_non_ascii(self):
+        yield self.mk_transport(
+            outbound_url=urljoin(self.remote_server.url, 'nonreply?foo=bar'))
+
+        reqs = self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content=u'ポケモン')
+
+        [req] = reqs
+
+        self.assertTrue(req.uri.startswith('/nonreply'))
+        self.assertEqual(req.args, {
+            'foo': ['bar'],
+            'username': ['root'],
+            'message': ['????'],
+            'password': ['t00r'],
+            'sender': ['456'],
+            'receiver': ['+123'],
+            'message_type': ['1'],
+        })
+
     @inlineCallbacks
     def test_outbound_reply(self):
         yield self.mk_transport(
@@ -492,6 +748,38 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Basao',
         })
 
+    @inlineCallbacks
+    def test_outbound_error_trailing_newline(self):
+        def handler(req):
+            req.setResponseCode(200)
+            return 'ERR-33 Invalid login\n'
+
+        yield self.mk_transport()
+        self.remote_request_handler = handler
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'sent_message_id': msg['message_id'],
+            'nack_reason': 'Invalid login',
+        })
+
+        [status] = self.tx_helper.get_dispatched_statuses()
+
+        self.assert_contains_items(status, {
+            'status': 'down',
+            'component': 'outbound',
+            'type': 'invalid_login',
+            'message': 'Invalid login',
+        })
+
     @inlineCallbacks
     def test_outbound_error_status_code(self):
         def handler(req):
@@ -524,6 +812,52 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Bad Gateway',
         })
 
+    @inlineCallbacks
+    def test_outbound_large_response(self):
+        def handler(req):
+            req.setResponseCode(502)
+            return 'a' * 4096
+
+        yield self.mk_transport(max_response_bytes=16)
+        self.remote_request_handler = handler
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'sent_message_id': msg['message_id'],
+            'nack_reason': 'a' * 16,
+        })
+
+    @inlineCallbacks
+    def test_outbound_large_multibyte_response(self):
+        def handler(req):
+            req.setResponseCode(502)
+            return u'é'.encode('utf-8') * 100
+
+        yield self.mk_transport(max_response_bytes=17)
+        self.remote_request_handler = handler
+
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+
+        self.assert_contains_items(nack, {
+            'event_type': 'nack',
+            'user_message_id': msg['message_id'],
+            'sent_message_id': msg['message_id'],
+            'nack_reason': u'é' * 8,
+        })
+
     @inlineCallbacks
     def test_outbound_missing_fields(self):
         yield self.mk_transport()
@@ -577,6 +911,49 @@ class TestVas2NetsSmsTransport(VumiTestCase):
             'message': 'Request timeout',
         })
 
+    @inlineCallbacks
+    def test_setup_failure_teardown(self):
+        d = self.mk_transport(outbound_url=u'http://ポケモン.example.org/')
+        yield self.assertFailure(d, UnicodeEncodeError)
+
+    @inlineCallbacks
+    def test_outbound_connection_pool(self):
+        yield self.mk_transport(
+            http_pool_size=3,
+            http_pool_max_idle=30)
+
+        reqs = self.capture_remote_requests()
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi')
+
+        yield self.tx_helper.make_dispatch_outbound(
+            from_addr='456',
+            to_addr='+123',
+            content='hi again')
+
+        self.assertEqual(
+            [req.args['message'] for req in reqs],
+            [['hi'], ['hi again']])
+
+        # Both requests were sent over the same persistent connection
+        [req1, req2] = reqs
+        self.assertEqual(req1.client.port, req2.client.port)
+
+
+class RawResponseProtocol(Protocol):
+    def __init__(self):
+        self.done = Deferred()
+        self.chunks = []
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        self.done.callback(''.join(self.chunks))
+
 
 def map_get(collection, key):
     return dict((k, d.get(key)) for (k, d) in collection.iteritems())
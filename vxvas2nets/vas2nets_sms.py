@@ -1,16 +1,50 @@
 import re
 import json
-import treq
+from collections import OrderedDict
+from urllib import urlencode
 
 from twisted.web import http
-from twisted.internet.defer import inlineCallbacks, CancelledError
+from twisted.web.client import (
+    Agent, ContentDecoderAgent, GzipDecoder, HTTPConnectionPool,
+    RedirectAgent)
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, CancelledError, Deferred
 from twisted.internet.error import ConnectingCancelledError
+from twisted.internet.protocol import Protocol
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web._newclient import ResponseNeverReceived
 
 from vumi.config import ConfigText, ConfigInt
 from vumi.transports.httprpc import HttpRpcTransport
 
 
+EMPTY_JSON = json.dumps({})
+
+EMPTY_JSON_HEADERS = {'Content-Length': [str(len(EMPTY_JSON))]}
+
+INBOUND_SUCCESS_STATUS = {
+    'component': 'inbound',
+    'status': 'ok',
+    'type': 'request_success',
+    'message': 'Request successful',
+}
+
+OUTBOUND_SUCCESS_STATUS = {
+    'component': 'outbound',
+    'status': 'ok',
+    'type': 'request_success',
+    'message': 'Request successful',
+}
+
+OUTBOUND_TIMEOUT_STATUS = {
+    'component': 'outbound',
+    'status': 'down',
+    'type': 'request_timeout',
+    'message': 'Request timeout',
+}
+
+
 class Vas2NetsSmsTransportConfig(HttpRpcTransport.CONFIG_CLASS):
     """Config for SMS transport."""
 
@@ -23,6 +57,11 @@ class Vas2NetsSmsTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         "null for no timeout",
         default=None)
 
+    outbound_connect_timeout = ConfigInt(
+        "Timeout duration in seconds for connecting to the outbound host, or "
+        "null for the default connection timeout",
+        default=None, static=True)
+
     reply_outbound_url = ConfigText(
         "Url to use for reply outbound messages",
         required=True)
@@ -35,6 +74,30 @@ class Vas2NetsSmsTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         "Password to use for outbound messages",
         required=True)
 
+    http_pool_size = ConfigInt(
+        "Maximum number of persistent connections to keep open to the "
+        "outbound host",
+        default=10, static=True)
+
+    http_pool_max_idle = ConfigInt(
+        "Number of seconds an idle persistent connection to the outbound "
+        "host is kept open for",
+        default=240, static=True)
+
+    max_response_bytes = ConfigInt(
+        "Maximum number of bytes to read from the body of a response to an "
+        "outbound message. Anything past this is discarded",
+        default=512, static=True)
+
+    inbound_dedup_size = ConfigInt(
+        "Number of recent inbound message ids to remember. Inbound requests "
+        "with a message id we have already published are acknowledged "
+        "without being published again. Ids are only remembered once their "
+        "message has been published, so requests with the same id that "
+        "arrive while the first is still being published are all published. "
+        "Defaults to 0, which disables this",
+        default=0, static=True)
+
 
 class Vas2NetsSmsTransport(HttpRpcTransport):
     CONFIG_CLASS = Vas2NetsSmsTransportConfig
@@ -71,17 +134,100 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
     ENCODING = 'utf-8'
 
+    # Maximum number of bytes of a request's content to include in the
+    # request details we log and publish for bad requests. This also keeps
+    # the JSON bodies we respond with for bad requests small enough to encode
+    # on the reactor thread
+    MAX_REQUEST_CONTENT_BYTES = 4096
+
     transport_type = 'sms'
 
+    @inlineCallbacks
+    def setup_transport(self):
+        # The pool is created before anything else can fail, so that
+        # teardown_transport can always close it
+        config = self.get_static_config()
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = config.http_pool_size
+        self._pool.cachedConnectionTimeout = config.http_pool_max_idle
+        self._agent = ContentDecoderAgent(
+            RedirectAgent(Agent(
+                reactor,
+                pool=self._pool,
+                connectTimeout=config.outbound_connect_timeout)),
+            [('gzip', GzipDecoder)])
+
+        yield super(Vas2NetsSmsTransport, self).setup_transport()
+
+        # The credentials are the same for every outbound message, so we
+        # encode them into the url once here rather than per send
+        base_query = encode_params({
+            'username': self.config['username'],
+            'password': self.config['password'],
+
+            # From docs:
+            # flag indicating normal text message
+            # 0 or 1  Note: 1=flash, 0=text (This is optional, the default is
+            # 0 i.e text)
+            # From testing, it appears they are expecting this value to always
+            # be 1
+            'message_type': '1',
+        })
+
+        self._send_url_prefix = get_url_prefix(
+            self.config['outbound_url'], base_query)
+
+        if self.use_mo_response_url():
+            self._reply_send_url_prefix = get_url_prefix(
+                self.config['reply_outbound_url'], base_query)
+
+        self._get_send_fail_type = self.SEND_FAIL_TYPES.get
+
+        self._seen_msgids = OrderedDict()
+        self._max_seen_msgids = config.inbound_dedup_size
+
+    @inlineCallbacks
+    def teardown_transport(self):
+        yield self._pool.closeCachedConnections()
+        yield super(Vas2NetsSmsTransport, self).teardown_transport()
+
     def get_request_dict(self, request):
+        # Only read one byte past the limit, which is enough to tell whether
+        # the content was truncated
+        content = request.content.read(self.MAX_REQUEST_CONTENT_BYTES + 1)
+        truncated = len(content) > self.MAX_REQUEST_CONTENT_BYTES
+
+        if truncated:
+            content = truncate_utf8(content, self.MAX_REQUEST_CONTENT_BYTES)
+
         return {
             'uri': request.uri,
             'method': request.method,
             'path': request.path,
-            'content': request.content.read(),
+            'content': content,
+            'content_truncated': truncated,
             'headers': dict(request.requestHeaders.getAllRawHeaders()),
         }
 
+    def is_seen_msgid(self, msgid):
+        if msgid not in self._seen_msgids:
+            return False
+
+        # Move the id to the end, so that ids that keep getting retried are
+        # the last to be forgotten
+        del self._seen_msgids[msgid]
+        self._seen_msgids[msgid] = True
+        return True
+
+    def add_seen_msgid(self, msgid):
+        if self._max_seen_msgids <= 0:
+            return
+
+        self._seen_msgids[msgid] = True
+
+        if len(self._seen_msgids) > self._max_seen_msgids:
+            self._seen_msgids.popitem(last=False)
+
     def get_message_dict(self, message_id, vals):
         return {
             'message_id': message_id,
@@ -94,30 +240,20 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             'transport_metadata': {'vas2nets_sms': {'msgid': vals['msgid']}}
         }
 
-    def get_send_url(self, message):
+    def get_send_url_prefix(self, message):
         if self.use_mo_response_url() and self.is_mo_response(message):
-            return self.config['reply_outbound_url']
+            return self._reply_send_url_prefix
         else:
-            return self.config['outbound_url']
+            return self._send_url_prefix
 
     def get_send_params(self, message):
         params = {
-            'username': self.config['username'],
-            'password': self.config['password'],
             'sender': message['from_addr'],
             'receiver': message['to_addr'],
             'message': message['content'],
-
-            # From docs:
-            # flag indicating normal text message
-            # 0 or 1  Note: 1=flash, 0=text (This is optional, the default is 0
-            # i.e text)
-            # From testing, it appears they are expecting this value to always
-            # be 1
-            'message_type': '1',
         }
 
-        id = get_in(message, 'transport_metadata', 'vas2nets_sms', 'msgid')
+        id = get_msgid(message)
 
         # from docs:
         # If MO Message ID is validated, MT will not be charged.
@@ -127,14 +263,19 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
         return params
 
+    def get_send_url(self, message):
+        return '%s&%s' % (
+            self.get_send_url_prefix(message),
+            encode_params(self.get_send_params(message)))
+
     def get_send_fail_type(self, code):
-        return self.SEND_FAIL_TYPES.get(code, 'request_fail_unknown')
+        return self._get_send_fail_type(code, 'request_fail_unknown')
 
     def use_mo_response_url(self):
         return self.config.get('reply_outbound_url') is not None
 
     def is_mo_response(self, message):
-        return get_in(message, 'transport_metadata', 'vas2nets_sms', 'msgid')
+        return get_msgid(message)
 
     def get_nack_reason(self, error):
         description = {
@@ -160,7 +301,24 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             error, "Unknown request failure: %s" % (error,))
 
     def get_send_status(self, content):
-        match = self.ERROR_RE.search(content)
+        if not content.startswith('ERR-'):
+            return {
+                'code': None,
+                'message': content
+            }
+
+        # Error responses are almost always a single `ERR-<n> <message>`
+        # line, which we can split without going through the regex
+        if '\n' not in content:
+            code, sep, message = content.partition(' ')
+
+            if sep and code[4:].isdigit():
+                return {
+                    'code': code,
+                    'message': message,
+                }
+
+        match = self.ERROR_RE.match(content)
 
         if match is None:
             return {
@@ -174,16 +332,26 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             }
 
     def respond(self, message_id, code, body=None):
-        if body is None:
-            body = {}
-
-        self.finish_request(message_id, json.dumps(body), code=code)
+        # We give the response a content length so that it is written as a
+        # single body rather than with chunked encoding
+        if not body:
+            self.finish_request(
+                message_id, EMPTY_JSON, code=code, headers=EMPTY_JSON_HEADERS)
+        else:
+            data = json.dumps(body)
+            self.finish_request(
+                message_id, data, code=code,
+                headers={'Content-Length': [str(len(data))]})
 
     def send_message(self, message):
-        return treq.get(
-            url=self.get_send_url(message),
-            params=self.get_send_params(message),
-            timeout=self.config.get('outbound_request_timeout'))
+        d = self._agent.request('GET', self.get_send_url(message))
+        timeout = self.config.get('outbound_request_timeout')
+
+        if timeout:
+            timeout_call = self.clock.callLater(timeout, d.cancel)
+            d.addBoth(cancel_delayed_call, timeout_call)
+
+        return d
 
     @inlineCallbacks
     def handle_raw_inbound_message(self, message_id, request):
@@ -233,23 +401,32 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
 
     @inlineCallbacks
     def handle_inbound_message(self, message_id, request, vals):
+        if self.is_seen_msgid(vals['msgid']):
+            self.emit('Ignoring duplicate inbound message: %s' % (
+                vals['msgid'],))
+            self.respond(message_id, http.OK, {})
+            return
+
         yield self.publish_message(
             **self.get_message_dict(message_id, vals))
 
+        self.add_seen_msgid(vals['msgid'])
         self.respond(message_id, http.OK, {})
 
-        yield self.add_status(
-            component='inbound',
-            status='ok',
-            type='request_success',
-            message='Request successful')
+        # add_status only publishes when the status changes, so in the steady
+        # state this doesn't result in an extra publish per message
+        yield self.add_status(**INBOUND_SUCCESS_STATUS)
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
-        missing_fields = self.ensure_message_values(
-            message, self.EXPECTED_MESSAGE_FIELDS)
+        # Check the expected fields directly, only working out which ones are
+        # missing if the check fails
+        if not (message['from_addr'] and
+                message['to_addr'] and
+                message['content']):
+            missing_fields = self.ensure_message_values(
+                message, self.EXPECTED_MESSAGE_FIELDS)
 
-        if missing_fields:
             yield self.reject_message(message, missing_fields)
             return
 
@@ -260,9 +437,10 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             yield self.handle_send_timeout(message)
             return
 
-        content = yield resp.content()
+        content = yield read_body(
+            resp, self.get_static_config().max_response_bytes)
         status = self.get_send_status(content)
-        self.emit('Vas2Nets response for %s: %s, status: %s' % (
+        self.emit('Vas2Nets response for %s: %r, status: %s' % (
             message['message_id'], content, status))
 
         if resp.code == http.OK and status['code'] is None:
@@ -282,11 +460,7 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             sent_message_id=message['message_id'],
             reason='Request timeout')
 
-        yield self.add_status(
-            component='outbound',
-            status='down',
-            type='request_timeout',
-            message='Request timeout')
+        yield self.add_status(**OUTBOUND_TIMEOUT_STATUS)
 
     @inlineCallbacks
     def handle_outbound_success(self, message):
@@ -295,11 +469,7 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             user_message_id=message['message_id'],
             sent_message_id=message['message_id'])
 
-        yield self.add_status(
-            component='outbound',
-            status='ok',
-            type='request_success',
-            message='Request successful')
+        yield self.add_status(**OUTBOUND_SUCCESS_STATUS)
 
     @inlineCallbacks
     def handle_outbound_fail(self, message, status):
@@ -316,11 +486,88 @@ class Vas2NetsSmsTransport(HttpRpcTransport):
             message=status['message'])
 
 
-def get_in(data, *keys):
-    for key in keys:
-        data = data.get(key)
+def truncate_utf8(data, max_bytes):
+    """
+    Truncates `data` to at most `max_bytes`, stepping back over utf-8
+    continuation bytes so that we don't split a multi-byte character.
+    """
+    end = max_bytes
+
+    # A utf-8 character is at most 4 bytes, so we step back over at most 3
+    # continuation bytes (0b10xxxxxx)
+    while (end > max_bytes - 3 and end > 0 and
+           ord(data[end]) & 0xC0 == 0x80):
+        end -= 1
+
+    return data[:end]
+
+
+def get_url_prefix(url, query):
+    # Agent only accepts byte string urls
+    url = url.encode('ascii')
+
+    if '?' in url:
+        return '%s&%s' % (url, query)
+    else:
+        return '%s?%s' % (url, query)
+
+
+def cancel_delayed_call(result, delayed_call):
+    if delayed_call.active():
+        delayed_call.cancel()
+
+    return result
+
+
+def encode_params(params):
+    # With doseq, urlencode encodes unicode values as ascii, replacing any
+    # other characters with '?'. This matches how treq used to encode the
+    # params for us
+    return urlencode(params, doseq=True)
+
+
+def get_msgid(message):
+    try:
+        return message['transport_metadata']['vas2nets_sms']['msgid']
+    except (KeyError, TypeError):
+        return None
+
+
+class BoundedBodyReader(Protocol):
+    """
+    Collects at most `max_bytes` of a response body, then stops the
+    transfer.
+    """
+    def __init__(self, finished, max_bytes):
+        self.finished = finished
+        self.max_bytes = max_bytes
+        # We keep one byte past the limit, which is enough to tell whether
+        # the body was truncated and where the last whole character ends
+        self.remaining = max_bytes + 1
+        self.chunks = []
+
+    def dataReceived(self, data):
+        if self.remaining <= 0:
+            return
+
+        self.chunks.append(data[:self.remaining])
+        self.remaining -= len(data)
+
+        if self.remaining <= 0:
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        body = ''.join(self.chunks)
+
+        if len(body) > self.max_bytes:
+            self.finished.callback(truncate_utf8(body, self.max_bytes))
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(body)
+        else:
+            self.finished.errback(reason)
 
-        if data is None:
-            return None
 
-    return data
+def read_body(response, max_bytes):
+    d = Deferred()
+    response.deliverBody(BoundedBodyReader(d, max_bytes))
+    return d